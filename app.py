@@ -6,27 +6,115 @@ Flask backend for the image downloader with modern web UI
 
 import eventlet
 eventlet.monkey_patch()
+from eventlet import tpool
 
-from flask import Flask, render_template, request, jsonify, send_file
+from flask import Flask, render_template, request, jsonify, send_from_directory
 from flask_socketio import SocketIO, emit
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
-from urllib.parse import urlparse
+import queue
+from urllib.parse import urlsplit
 from pathlib import Path
 import re
+import shutil
 from PIL import Image
+import img2pdf
+import orjson
 import tempfile
+import secrets
 import threading
-import uuid
+import time
+from collections import OrderedDict
 from datetime import datetime
 import zipfile
 
+class OrjsonCodec:
+    """orjson-backed drop-in for the json module Socket.IO serializes with"""
+    @staticmethod
+    def dumps(obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    @staticmethod
+    def loads(data, **kwargs):
+        return orjson.loads(data)
+
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your-secret-key-here'
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode='eventlet')
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode='eventlet', json=OrjsonCodec)
+
+# Store active downloads, oldest first; bounded so long-running servers
+# don't accumulate an entry per request forever
+active_downloads = OrderedDict()
+active_downloads_lock = threading.Lock()
+MAX_ACTIVE_DOWNLOADS = 1024
+
+# How long a finished download stays visible before being dropped
+COMPLETED_DOWNLOAD_TTL = 300
+
+# Minimum seconds between progress emits for the same download
+EMIT_MIN_INTERVAL = 0.1
+
+_timestamp_cache = (0, '')
+
+def format_timestamp():
+    """H:M:S for progress payloads, reformatted at most once per second"""
+    global _timestamp_cache
+    now = int(time.time())
+    if _timestamp_cache[0] != now:
+        _timestamp_cache = (now, datetime.now().strftime("%H:%M:%S"))
+    return _timestamp_cache[1]
+
+def register_download(manager):
+    """Track a download, evicting the oldest finished entry when full"""
+    with active_downloads_lock:
+        active_downloads[manager.download_id] = manager
+        while len(active_downloads) > MAX_ACTIVE_DOWNLOADS:
+            for download_id, old in active_downloads.items():
+                if not old.is_downloading:
+                    del active_downloads[download_id]
+                    break
+            else:
+                active_downloads.popitem(last=False)
+
+def expire_download(download_id):
+    """Drop a finished download from tracking"""
+    with active_downloads_lock:
+        active_downloads.pop(download_id, None)
+
+# Where finished downloads are written and served from; absolute so the
+# serve path never depends on the working directory
+DOWNLOADS_DIR = os.path.abspath('./downloads')
+
+# Concurrent page fetches per batch download
+FETCH_POOL_SIZE = 16
 
-# Store active downloads
-active_downloads = {}
+# Shared session so batch downloads reuse keep-alive connections instead of
+# paying a TCP+TLS handshake per image
+SESSION = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=64,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+)
+SESSION.mount('http://', _adapter)
+SESSION.mount('https://', _adapter)
+
+# Copy chunk size when streaming response bodies to disk
+STREAM_CHUNK_SIZE = 1024 * 64
+
+# Image bodies won't compress further, but error pages from misses will
+REQUEST_HEADERS = {'Accept-Encoding': 'gzip, br'}
+
+# Last run of digits before the file extension, e.g. "page_0042.jpg"
+PAGE_NUMBER_RE = re.compile(r'(\d+)(?=\.[^.]*$)')
+
+def url_filename(url):
+    """Final path segment of a URL"""
+    # urlsplit skips the params-parsing pass urlparse pays for, which
+    # adds up over a multi-thousand page batch
+    return urlsplit(url).path.rsplit('/', 1)[-1]
 
 class DownloadManager:
     def __init__(self, download_id):
@@ -36,26 +124,43 @@ class DownloadManager:
         self.total = 0
         self.current_file = ""
         self.status = "ready"
-        
+        self._lock = threading.Lock()
+        self._last_emit = 0.0
+
     def emit_progress(self, message, progress=None, status=None, filename=None):
         """Emit progress update to client"""
-        if progress is not None:
-            self.progress = progress
-        if status is not None:
-            self.status = status
-            
-        payload = {
-            'download_id': self.download_id,
-            'message': message,
-            'progress': self.progress,
-            'total': self.total,
-            'status': self.status,
-            'timestamp': datetime.now().strftime("%H:%M:%S")
-        }
-        
+        # Snapshot the fields under the lock; concurrent page workers
+        # all report through the same manager
+        with self._lock:
+            status_changed = status is not None and status != self.status
+            if progress is not None:
+                self.progress = progress
+            if status is not None:
+                self.status = status
+
+            # Debounce the per-page flood: a 1000-page batch would
+            # otherwise push 1000+ Socket.IO messages, and the encode
+            # and send run on the worker's critical path. Status
+            # changes and the final page always go out
+            now = time.monotonic()
+            if not (status_changed or filename is not None
+                    or self.progress == self.total
+                    or now - self._last_emit > EMIT_MIN_INTERVAL):
+                return
+            self._last_emit = now
+
+            payload = {
+                'download_id': self.download_id,
+                'message': message,
+                'progress': self.progress,
+                'total': self.total,
+                'status': self.status,
+                'timestamp': format_timestamp()
+            }
+
         if filename:
             payload['filename'] = filename
-            
+
         socketio.emit('download_progress', payload)
 
 @app.route('/')
@@ -75,15 +180,13 @@ def download_single():
     if not url.startswith(('http://', 'https://')):
         return jsonify({'error': 'URL must start with http:// or https://'}), 400
     
-    download_id = str(uuid.uuid4())
+    download_id = secrets.token_urlsafe(16)
     manager = DownloadManager(download_id)
-    active_downloads[download_id] = manager
-    
-    # Start download in background
-    thread = threading.Thread(target=download_single_worker, args=(manager, url))
-    thread.daemon = True
-    thread.start()
-    
+    register_download(manager)
+
+    # Start download in background on the eventlet hub
+    socketio.start_background_task(download_single_worker, manager, url)
+
     return jsonify({'download_id': download_id})
 
 @app.route('/api/download/batch', methods=['POST'])
@@ -101,15 +204,13 @@ def download_batch():
     if output_format not in ['pdf', 'zip']:
         return jsonify({'error': 'Invalid output format. Must be pdf or zip'}), 400
     
-    download_id = str(uuid.uuid4())
+    download_id = secrets.token_urlsafe(16)
     manager = DownloadManager(download_id)
-    active_downloads[download_id] = manager
-    
-    # Start download in background
-    thread = threading.Thread(target=download_batch_worker, args=(manager, start_url, end_url, output_name, output_format))
-    thread.daemon = True
-    thread.start()
-    
+    register_download(manager)
+
+    # Start download in background on the eventlet hub
+    socketio.start_background_task(download_batch_worker, manager, start_url, end_url, output_name, output_format)
+
     return jsonify({'download_id': download_id})
 
 def download_single_worker(manager, url):
@@ -119,15 +220,17 @@ def download_single_worker(manager, url):
         manager.total = 1
         manager.emit_progress("Starting download...", 0, "downloading")
         
-        Path("./downloads").mkdir(exist_ok=True)
-        response = requests.get(url, timeout=30)
-        response.raise_for_status()
-        
-        filename = os.path.basename(urlparse(url).path) or "image.jpg"
-        filepath = os.path.join("./downloads", filename)
-        
-        with open(filepath, 'wb') as f:
-            f.write(response.content)
+        Path(DOWNLOADS_DIR).mkdir(exist_ok=True)
+        filename = url_filename(url) or "image.jpg"
+        filepath = os.path.join(DOWNLOADS_DIR, filename)
+
+        # Stream straight to disk instead of buffering the whole image;
+        # the with block returns the connection to the pool promptly
+        with SESSION.get(url, timeout=(5, 30), stream=True, headers=REQUEST_HEADERS) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True
+            with open(filepath, 'wb') as f:
+                shutil.copyfileobj(response.raw, f, STREAM_CHUNK_SIZE)
         
         manager.emit_progress(f"✅ Image saved: {filename}", 1, "completed", filename)
         
@@ -135,6 +238,8 @@ def download_single_worker(manager, url):
         manager.emit_progress(f"❌ Download failed: {str(e)}", 0, "error")
     finally:
         manager.is_downloading = False
+        # Keep the final status visible for a while, then drop the entry
+        threading.Timer(COMPLETED_DOWNLOAD_TTL, expire_download, (manager.download_id,)).start()
 
 def download_batch_worker(manager, start_url, end_url, output_name, output_format):
     """Worker for batch download and PDF/ZIP conversion"""
@@ -156,18 +261,54 @@ def download_batch_worker(manager, start_url, end_url, output_name, output_forma
         
         # Create temporary directory
         with tempfile.TemporaryDirectory() as temp_dir:
-            downloaded_images = []
-            
-            # Download all images
-            for i, page_num in enumerate(range(start_num, end_num + 1)):
-                current_url = url_template.format(page_num)
-                filename = os.path.basename(urlparse(current_url).path)
-                
-                manager.emit_progress(f"📥 Downloading {filename} ({i+1}/{total_pages})", i, "downloading")
-                
-                temp_path = download_image_to_temp(current_url, temp_dir)
-                downloaded_images.append(temp_path)
-            
+            # Download all pages concurrently; each green thread yields to the
+            # eventlet hub while waiting on the socket, so I/O overlaps
+            pool = eventlet.GreenPool(FETCH_POOL_SIZE)
+            # Bounded handoff between the download producers and the
+            # page-preparation consumer so the network and CPU stages
+            # overlap instead of running back to back
+            ready = queue.Queue(maxsize=8)
+            prepared = {}
+            completed = [0]
+
+            def fetch_page(page_num):
+                temp_path = None
+                try:
+                    current_url = url_template.format(page_num)
+                    filename = url_filename(current_url)
+                    temp_path = download_image_to_temp(current_url, temp_dir)
+                    completed[0] += 1
+                    manager.emit_progress(f"📥 Downloaded {filename} ({completed[0]}/{total_pages})", completed[0], "downloading")
+                finally:
+                    # Always hand the slot over so the consumer sees
+                    # exactly one entry per page
+                    ready.put((page_num, temp_path))
+
+            def prepare_pages():
+                # Reorder buffer: completions arrive in any order, pages
+                # are prepared in page order while later downloads are
+                # still in flight
+                pending = {}
+                next_num = start_num
+                for _ in range(total_pages):
+                    page_num, temp_path = ready.get()
+                    pending[page_num] = temp_path
+                    while next_num in pending:
+                        temp_path = pending.pop(next_num)
+                        if temp_path is not None and output_format == 'pdf':
+                            temp_path = prepare_for_pdf(temp_path)
+                        prepared[next_num] = temp_path
+                        next_num += 1
+
+            consumer = eventlet.spawn(prepare_pages)
+            for page_num in range(start_num, end_num + 1):
+                pool.spawn_n(fetch_page, page_num)
+            pool.waitall()
+            consumer.wait()
+
+            # Reassemble in page order for the PDF/ZIP stage
+            downloaded_images = [prepared.get(n) for n in range(start_num, end_num + 1)]
+
             # Filter out failed downloads
             valid_images = [img for img in downloaded_images if img is not None]
             
@@ -178,11 +319,11 @@ def download_batch_worker(manager, start_url, end_url, output_name, output_forma
             manager.emit_progress(f"✅ Downloaded {len(valid_images)}/{total_pages} images", total_pages, "converting")
             
             # Create output based on format
-            Path("./downloads").mkdir(exist_ok=True)
-            
+            Path(DOWNLOADS_DIR).mkdir(exist_ok=True)
+
             if output_format == 'pdf':
                 output_filename = f"{output_name}.pdf"
-                output_path = os.path.join("./downloads", output_filename)
+                output_path = os.path.join(DOWNLOADS_DIR, output_filename)
                 manager.emit_progress("📄 Converting to PDF...", total_pages, "converting")
                 
                 if images_to_pdf(valid_images, output_path):
@@ -192,7 +333,7 @@ def download_batch_worker(manager, start_url, end_url, output_name, output_forma
             
             elif output_format == 'zip':
                 output_filename = f"{output_name}.zip"
-                output_path = os.path.join("./downloads", output_filename)
+                output_path = os.path.join(DOWNLOADS_DIR, output_filename)
                 manager.emit_progress("📦 Creating ZIP archive...", total_pages, "converting")
                 
                 if images_to_zip(valid_images, output_path):
@@ -204,78 +345,170 @@ def download_batch_worker(manager, start_url, end_url, output_name, output_forma
         manager.emit_progress(f"❌ Batch download failed: {str(e)}", 0, "error")
     finally:
         manager.is_downloading = False
+        # Keep the final status visible for a while, then drop the entry
+        threading.Timer(COMPLETED_DOWNLOAD_TTL, expire_download, (manager.download_id,)).start()
 
 def extract_url_pattern(start_url, end_url):
     """Extract the pattern and range from start and end URLs"""
-    start_match = re.search(r'(\d+)(?=\.[^.]*$)', start_url)
-    end_match = re.search(r'(\d+)(?=\.[^.]*$)', end_url)
-    
+    start_match = PAGE_NUMBER_RE.search(start_url)
+    end_match = PAGE_NUMBER_RE.search(end_url)
+
     if not start_match or not end_match:
         raise ValueError("Could not find numeric pattern in URLs")
-    
+
     start_num = int(start_match.group(1))
     end_num = int(end_match.group(1))
-    
-    # Create URL template
-    url_template = start_url.replace(start_match.group(1), "{:04d}")
-    
+
+    # Splice the placeholder in at the matched span (str.replace would
+    # also rewrite the same digits elsewhere in the URL), keeping the
+    # zero-padding width of the original number
+    start, end = start_match.span(1)
+    url_template = start_url[:start] + "{:0%dd}" % (end - start) + start_url[end:]
+
     return url_template, start_num, end_num
 
+def preallocate_file(f, content_length):
+    """Pre-size a file to the announced Content-Length so concurrent
+    downloads write into pre-reserved disjoint extents"""
+    try:
+        length = int(content_length)
+    except (TypeError, ValueError):
+        return
+    if length <= 0:
+        return
+    try:
+        os.posix_fallocate(f.fileno(), 0, length)
+    except (AttributeError, OSError):
+        f.truncate(length)
+
 def download_image_to_temp(url, temp_dir):
     """Download image to temporary directory"""
     try:
-        response = requests.get(url, timeout=30)
-        response.raise_for_status()
-        
-        filename = os.path.basename(urlparse(url).path)
+        filename = url_filename(url)
         temp_path = os.path.join(temp_dir, filename)
-        
-        with open(temp_path, 'wb') as f:
-            f.write(response.content)
-        
+
+        # Probe with HEAD first: guessed numeric ranges routinely 404 at
+        # the tail, and a header-only round-trip is far cheaper than a
+        # failed GET with an error body
+        probe = SESSION.head(url, timeout=(5, 5), allow_redirects=True, headers=REQUEST_HEADERS)
+        if probe.status_code == 404:
+            return None
+
+        with SESSION.get(url, timeout=(5, 30), stream=True, headers=REQUEST_HEADERS) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True
+            with open(temp_path, 'wb') as f:
+                preallocate_file(f, response.headers.get('Content-Length'))
+                shutil.copyfileobj(response.raw, f, STREAM_CHUNK_SIZE)
+                # Trim in case the body was shorter than announced
+                f.truncate(f.tell())
+
         return temp_path
         
     except Exception as e:
         return None
 
+def reencode_rgb_jpeg(img_path):
+    """Decode an image and re-encode it as an RGB JPEG next to the original"""
+    out_path = img_path + '.rgb.jpg'
+    with Image.open(img_path) as img:
+        img.convert('RGB').save(out_path, 'JPEG', quality=95)
+    return out_path
+
+def prepare_for_pdf(img_path):
+    """Re-encode a page as RGB JPEG if img2pdf cannot embed it directly"""
+    try:
+        with Image.open(img_path) as img:
+            needs_reencode = (img.mode in ('RGBA', 'LA', 'PA')
+                              or (img.mode == 'P' and 'transparency' in img.info))
+        if not needs_reencode:
+            return img_path
+        # Pillow releases the GIL in its C codecs, so running the
+        # re-encode in eventlet's native thread pool uses multiple cores
+        return tpool.execute(reencode_rgb_jpeg, img_path)
+    except Exception as e:
+        return img_path
+
 def images_to_pdf(image_paths, output_path):
     """Convert list of image paths to PDF"""
-    try:
-        images = []
-        
-        for img_path in image_paths:
-            if img_path and os.path.exists(img_path):
-                img = Image.open(img_path)
-                if img.mode != 'RGB':
-                    img = img.convert('RGB')
-                images.append(img)
-        
-        if images:
-            images[0].save(output_path, save_all=True, append_images=images[1:])
-            return True
+    valid_paths = [p for p in image_paths if p and os.path.exists(p)]
+    if not valid_paths:
         return False
-        
+
+    # Pre-convert incompatible pages in parallel, preserving page order
+    pool = eventlet.GreenPool(os.cpu_count() or 4)
+    prepared_paths = list(pool.imap(prepare_for_pdf, valid_paths))
+
+    # img2pdf wraps the already-compressed image bytes directly in PDF
+    # objects, so pages are never decoded or re-encoded
+    try:
+        with open(output_path, 'wb') as f:
+            f.write(img2pdf.convert(prepared_paths))
+        return True
+    except Exception as e:
+        # Fall back for inputs img2pdf rejects (e.g. alpha channels)
+        return images_to_pdf_pillow(prepared_paths, output_path)
+
+def images_to_pdf_pillow(image_paths, output_path):
+    """Re-encode images to PDF with Pillow (fallback path)"""
+    try:
+        if not image_paths:
+            return False
+
+        # Append pages to the PDF one at a time so only a single decoded
+        # image is ever resident; collecting them for append_images keeps
+        # every page in memory at once
+        for i, img_path in enumerate(image_paths):
+            img = Image.open(img_path)
+            # Let libjpeg decode straight to RGB and skip the separate
+            # colorspace pass where it can
+            img.draft('RGB', img.size)
+            img.load()  # decode now so the file descriptor is released
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
+            img.save(output_path, format='PDF', append=(i > 0))
+            img.close()
+        return True
+
     except Exception as e:
         return False
 
+# Formats that are already compressed; deflating them burns CPU for <1% gain
+PRECOMPRESSED_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp', '.gif'}
+
 def images_to_zip(image_paths, output_path):
     """Create ZIP archive from list of image paths"""
     try:
-        with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as zipf:
             for img_path in image_paths:
                 if img_path and os.path.exists(img_path):
                     # Get just the filename for the archive
                     arcname = os.path.basename(img_path)
-                    zipf.write(img_path, arcname)
+                    ext = os.path.splitext(arcname)[1].lower()
+                    if ext in PRECOMPRESSED_EXTENSIONS:
+                        compress_type = zipfile.ZIP_STORED
+                    else:
+                        compress_type = zipfile.ZIP_DEFLATED
+                    # Stream file-to-archive so large images are never
+                    # held in memory whole
+                    info = zipfile.ZipInfo.from_file(img_path, arcname)
+                    info.compress_type = compress_type
+                    with open(img_path, 'rb') as src, zipf.open(info, 'w') as dst:
+                        shutil.copyfileobj(src, dst, STREAM_CHUNK_SIZE)
         return True
-        
+
     except Exception as e:
         return False
 
 @app.route('/downloads/<filename>')
 def download_file(filename):
     """Serve downloaded files"""
-    return send_file(os.path.join('./downloads', filename), as_attachment=True)
+    # send_from_directory safe_joins the name against the directory, so
+    # traversal attempts like ../app.py 404 instead of being served.
+    # conditional=True enables ETag revalidation (304s on re-download)
+    # and range requests, and lets the WSGI layer use sendfile(2)
+    return send_from_directory(DOWNLOADS_DIR, filename, as_attachment=True,
+                               conditional=True, max_age=3600)
 
 if __name__ == '__main__':
     import os